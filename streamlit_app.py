@@ -1,9 +1,17 @@
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+import orjson
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import datetime as dt
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from zoneinfo import ZoneInfo
 
 # Konfiguration
@@ -16,64 +24,198 @@ INCLUDE_VAT = False
 COLOR_TOP16_PURPLE = "#8E44AD"
 COLOR_NEXT8_RED = "#E74C3C"
 COLOR_OTHER_GREEN = "#2ECC71"
+BAR_COLLECTION_THRESHOLD = 300
+REFRESH_INTERVAL_S = 15 * 60
 
-def build_api_url(date):
-    return f"https://www.elprisetjustnu.se/api/v1/prices/{date.year}/{date:%m}-{date:%d}_{PRICE_AREA}.json"
+def build_api_url(date, area=PRICE_AREA):
+    return f"https://www.elprisetjustnu.se/api/v1/prices/{date.year}/{date:%m}-{date:%d}_{area}.json"
 
-def fetch_day_prices(date):
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    s = requests.Session()
+    s.headers["Accept-Encoding"] = "gzip"
+    s.headers["User-Agent"] = "rst-elpris/1.0"
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return s
+
+@st.cache_resource(show_spinner=False)
+def _etag_store():
+    return {}
+
+def _download_day_prices(date, area=PRICE_AREA):
+    etags = _etag_store()
+    cached = etags.get((date, area))
+    headers = {"If-None-Match": cached[0]} if cached else {}
     try:
-        resp = requests.get(build_api_url(date), timeout=15)
-        if resp.status_code != 200:
+        resp = _http_session().get(build_api_url(date, area), headers=headers, timeout=15)
+        if resp.status_code == 304 and cached:
+            return cached[1]
+        if resp.status_code == 404:
+            # Dagen är inte publicerad ännu
             return None
-        data = resp.json()
-        return data if isinstance(data, list) else None
-    except:
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        raise LookupError(f"Hämtning misslyckades för {date} {area}") from e
+    if not isinstance(data, list) or not data:
+        raise LookupError(f"Oväntat svar för {date} {area}")
+    today = dt.datetime.now(TZ).date()
+    for key in [k for k in list(etags) if k[0] < today]:
+        etags.pop(key, None)
+    if "ETag" in resp.headers and date >= today:
+        etags[(date, area)] = (resp.headers["ETag"], data)
+    return data
+
+@st.cache_data(persist="disk", max_entries=730)
+def _fetch_finalized(date, area=PRICE_AREA):
+    rows = _download_day_prices(date, area)
+    if not rows:
+        # Undantag cachas inte, så en misslyckad hämtning hamnar aldrig på disk
+        raise LookupError(f"Inga priser för {date} {area}")
+    return rows
+
+@st.cache_data(ttl="15m", max_entries=64, show_spinner=False)
+def _fetch_live(date, area=PRICE_AREA):
+    return _download_day_prices(date, area)
+
+@st.cache_data(ttl="5m", max_entries=64, show_spinner=False)
+def _fetch_upcoming(date, area=PRICE_AREA):
+    return _download_day_prices(date, area)
+
+def _download_or_none(date, area=PRICE_AREA):
+    try:
+        return _download_day_prices(date, area)
+    except LookupError:
         return None
 
-def apply_unit_and_vat(sek_per_kwh):
-    price = sek_per_kwh * (1 + VAT_RATE) if INCLUDE_VAT else sek_per_kwh
-    return price * 100 if DISPLAY_ORE else price
+class _LatestPrices(dict):
+    # Egen klass eftersom dict inte kan ha weakrefs
+    pass
+
+def _refresh_latest(latest, area):
+    today = dt.datetime.now(TZ).date()
+    for key in [k for k in latest if k[0] < today]:
+        del latest[key]
+    days = (today, today + dt.timedelta(days=1))
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        for day, rows in zip(days, ex.map(_download_or_none, days, (area, area))):
+            if rows:
+                latest[(day, area)] = rows
+
+def _refresh_loop(ref, stop, area):
+    while not stop.wait(REFRESH_INTERVAL_S):
+        latest = ref()
+        if latest is None:
+            return
+        try:
+            _refresh_latest(latest, area)
+        except Exception:
+            logging.getLogger(__name__).exception("Uppdatering av elpriser misslyckades")
+        del latest
 
-def rank_sets(rows):
-    sorted_rows = sorted(rows, key=lambda r: r.get("SEK_per_kWh", 0.0), reverse=True)
-    top16 = {r["time_start"] for r in sorted_rows[:16]}
-    next8 = {r["time_start"] for r in sorted_rows[16:24]}
-    return top16, next8
+@st.cache_resource(show_spinner="Hämtar priser...")
+def _bg_refresher(area):
+    latest = _LatestPrices()
+    stop = threading.Event()
+    # Tråden håller bara en weakref; när cacheposten släpps stoppas den
+    weakref.finalize(latest, stop.set)
+    _refresh_latest(latest, area)
+    threading.Thread(target=_refresh_loop, args=(weakref.ref(latest), stop, area), name=f"elpris-refresh-{area}", daemon=True).start()
+    return latest
 
-def plot_day(rows, date):
-    df = pd.DataFrame(rows)
-    df["start"] = pd.to_datetime(df["time_start"]).dt.tz_convert(TZ)
-    df["price_display"] = df["SEK_per_kWh"].apply(apply_unit_and_vat)
+def fetch_day_prices(date, area=PRICE_AREA):
+    today = dt.datetime.now(TZ).date()
+    if date < today:
+        try:
+            return _fetch_finalized(date, area)
+        except LookupError:
+            return None
+    rows = _bg_refresher(area).get((date, area))
+    if rows:
+        return rows
+    try:
+        if date == today:
+            return _fetch_live(date, area)
+        if not _fetch_upcoming(date, area):
+            return None
+        # Publicerade dagar ändras inte; ETag gör hämtningen till en 304
+        return _fetch_finalized(date, area)
+    except LookupError:
+        return None
+
+def unit_and_vat_scale(display_ore=DISPLAY_ORE, include_vat=INCLUDE_VAT):
+    return (1 + VAT_RATE if include_vat else 1.0) * (100.0 if display_ore else 1.0)
+
+def rank_colors(prices):
+    colors = np.full(len(prices), COLOR_OTHER_GREEN, dtype=object)
+    idx = np.argsort(-prices, kind="stable")[:24]
+    colors[idx[:16]] = COLOR_TOP16_PURPLE
+    colors[idx[16:24]] = COLOR_NEXT8_RED
+    return colors
+
+@st.cache_data(ttl="15m", max_entries=64)
+def _parse_rows(date, area=PRICE_AREA):
+    rows = fetch_day_prices(date, area)
+    if not rows:
+        raise LookupError(f"Inga priser för {date} {area}")
+    n = len(rows)
+    prices = np.empty(n, dtype=np.float64)
+    starts = np.empty(n, dtype=object)
+    for i, r in enumerate(rows):
+        prices[i] = r["SEK_per_kWh"]
+        starts[i] = r["time_start"]
+    df = pd.DataFrame({"time_start": starts, "SEK_per_kWh": prices})
+    df["start"] = pd.to_datetime(starts, utc=True, format="ISO8601").tz_convert(TZ)
     df = df.sort_values("start").reset_index(drop=True)
-    top16, next8 = rank_sets(rows)
-    colors = []
-    for _, r in df.iterrows():
-        orig = r["time_start"]
-        if orig in top16:
-            colors.append(COLOR_TOP16_PURPLE)
-        elif orig in next8:
-            colors.append(COLOR_NEXT8_RED)
-        else:
-            colors.append(COLOR_OTHER_GREEN)
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.bar(range(len(df)), df["price_display"], color=colors)
+    df["hhmm"] = df["start"].dt.strftime("%H:%M")
+    return df
+
+@st.cache_data(ttl="15m", max_entries=64)
+def day_rank_colors(date, area=PRICE_AREA):
+    return rank_colors(_parse_rows(date, area)["SEK_per_kWh"].to_numpy())
+
+@st.cache_data(ttl="15m", max_entries=64)
+def get_display_df(date, area=PRICE_AREA, display_ore=DISPLAY_ORE, include_vat=INCLUDE_VAT):
+    df = _parse_rows(date, area)
+    scale = unit_and_vat_scale(display_ore, include_vat)
+    df["price_display"] = (df["SEK_per_kWh"].to_numpy(dtype=np.float64) * scale).astype(np.float32)
+    return df
+
+def plot_day(date):
+    df = get_display_df(date, PRICE_AREA, DISPLAY_ORE, INCLUDE_VAT)
+    colors = day_rank_colors(date)
+    fig = Figure(figsize=(10, 4))
+    ax = fig.subplots()
+    x = np.arange(len(df))
+    y = df["price_display"].to_numpy()
+    if len(df) > BAR_COLLECTION_THRESHOLD:
+        bar_width_pt = 0.8 * fig.get_figwidth() * 72 * ax.get_position().width / len(df)
+        ax.vlines(x, 0, y, colors=colors, linewidth=bar_width_pt)
+    else:
+        ax.bar(x, y, color=colors)
     ax.set_title(f"SE4 – {date:%Y-%m-%d}")
     ax.set_xlabel("Tid")
     unit = "öre/kWh" if DISPLAY_ORE else "SEK/kWh"
     ax.set_ylabel(f"Pris ({unit})")
     tick_step = 8
-    x_labels = [ts.strftime("%H:%M") for ts in df["start"]]
-    ax.set_xticks(range(0, len(df), tick_step))
-    ax.set_xticklabels([x_labels[i] for i in range(0, len(df), tick_step)], rotation=0)
+    hhmm = df["hhmm"].to_numpy()
+    ax.set_xticks(x[::tick_step])
+    ax.set_xticklabels(hhmm[::tick_step], rotation=0)
     ax.grid(axis="y", linestyle=":", alpha=0.3)
     st.pyplot(fig)
 
+@st.fragment
+def render_day(date):
+    try:
+        plot_day(date)
+    except LookupError:
+        st.warning("Data saknas eller ej publicerad ännu.")
+
 # Streamlit UI
 st.title("SE4 Kvartspriser")
+# Hämtar idag och imorgon parallellt så att dagbytet går direkt
+_bg_refresher(PRICE_AREA)
 choice = st.radio("Välj dag:", ["Idag", "Imorgon"])
 date = dt.datetime.now(TZ).date() if choice == "Idag" else (dt.datetime.now(TZ) + dt.timedelta(days=1)).date()
-rows = fetch_day_prices(date)
-if rows:
-    plot_day(rows, date)
-else:
-    st.warning("Data saknas eller ej publicerad ännu.")
+render_day(date)